@@ -8,25 +8,44 @@
 #
 
 import argparse
+import fcntl
 import json
 import logging
 import os
 import shutil
 import sys
 import urllib.request
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import MISSING, dataclass, fields
+from functools import lru_cache
 from pathlib import Path
-from subprocess import PIPE, Popen
-from typing import Dict, Iterator, List, Optional, Type
+from subprocess import PIPE, Popen, run
+from typing import Dict, FrozenSet, Iterator, List, Optional, TextIO, Type
 
 import yaml
-from PIL import Image
+
+try:
+  from yaml import CSafeLoader as SafeLoader
+except ImportError:
+  from yaml import SafeLoader
 
 # https://services.swpc.noaa.gov/products/animations/enlil.json
 CONFIG_NAME = 'enlil.yaml'
 NOAA = "https://services.swpc.noaa.gov"
 SOURCE_JSON = NOAA + "/products/animations/enlil.json"
-MARGIN_COLOR = (0x0, 0x0, 0x0)
+MAX_WORKERS = 8
+BUFFER_SIZE = 1 << 20
+FFMPEG = shutil.which('ffmpeg')
+# Present once the frames in target_dir are stored without the bottom margin.
+UNPADDED_MARKER = '.unpadded'
+
+# Hardware h264 encoders by order of preference, with their specific arguments.
+# They use their own rate control, video_preset and the libx264 CRF do not apply to them.
+HW_ENCODERS = {
+  'h264_videotoolbox': ['-b:v', '2M', '-pix_fmt', 'yuv420p'],
+  'h264_nvenc': ['-preset', 'p4', '-pix_fmt', 'yuv420p'],
+  'h264_qsv': ['-pix_fmt', 'nv12'],
+}
 
 logging.basicConfig(format='%(asctime)s %(name)s:%(lineno)d %(levelname)s - %(message)s',
                     datefmt='%Y/%m/%d %H:%M:%S', level=logging.INFO)
@@ -34,20 +53,33 @@ logger = logging.getLogger('enlil')
 
 
 class Workdir:
+  """The workdir is kept between runs, create_links only updates what changed.
+  A lock prevents two overlapping runs from updating the links at the same time."""
   def __init__(self, source: Path) -> None:
     self.workdir = source.joinpath('_workdir')
+    self.lockfd: Optional[TextIO] = None
 
   def __enter__(self) -> Path:
     try:
-      self.workdir.mkdir()
+      self.workdir.mkdir(exist_ok=True)
+      self.lockfd = self.workdir.joinpath('.lock').open('w', encoding='ascii')
+      fcntl.flock(self.lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
       return self.workdir
+    except BlockingIOError:
+      self.lockfd.close()
+      logger.error('"%s" is used by another process', self.workdir)
+      raise
     except IOError as err:
       raise err
 
   def __exit__(self, exc_type: Optional[Type[BaseException]],
                exc_value: Optional[BaseException],
                traceback: Optional[Type[BaseException]]) -> None:
-    shutil.rmtree(self.workdir)
+    # Temporary video files left by an interrupted ffmpeg
+    for tmp_file in self.workdir.glob('*.mp4'):
+      tmp_file.unlink(missing_ok=True)
+    fcntl.flock(self.lockfd, fcntl.LOCK_UN)
+    self.lockfd.close()
 
 
 @dataclass(slots=True)
@@ -55,15 +87,20 @@ class Config:
   target_dir: Path
   enlil_file: Path
   video_file: Path
+  video_preset: str = 'faster'
+  video_encoder: str = 'libx264'
 
   def __init__(self, **kwargs: Dict[str, str]) -> None:
     # pylint: disable=no-member
+    for field in fields(self):
+      if field.default is not MISSING:
+        setattr(self, field.name, field.default)
     for key, val in kwargs.items():
       if key not in self.__dataclass_fields__:
         logging.warning('Configuration attribute: %s ignored', key)
         continue
       if isinstance(val, str):
-        tmp_val = Path(val)
+        tmp_val = self.__dataclass_fields__[key].type(val)
       else:
         raise TypeError(f"Unexpected type for {key}: {type(val)}")
       setattr(self, key, tmp_val)
@@ -87,7 +124,7 @@ def read_config() -> Config:
 
   logger.debug('Reading config file "%s"', filename)
   with filename.open('r', encoding='utf-8') as confd:
-    config = yaml.safe_load(confd)
+    config = yaml.load(confd, Loader=SafeLoader)
 
   try:
     return Config(**config)
@@ -96,17 +133,6 @@ def read_config() -> Config:
     raise SystemExit(err) from None
 
 
-def add_margin(im_name: Path, top: int, right: int, bottom: int, left: int) -> None:
-  color = MARGIN_COLOR
-  image = Image.open(im_name)
-  width, height = image.size
-  new_width = width + right + left
-  new_height = height + top + bottom
-  new_image = Image.new(image.mode, (new_width, new_height), color)
-  new_image.paste(image, (left, top))
-  new_image.save(im_name)
-
-
 def download_with_etag(url: str, filename: Path) -> bool:
   etag_file = filename.with_suffix('.etag')
   etag = None
@@ -123,7 +149,7 @@ def download_with_etag(url: str, filename: Path) -> bool:
       if response.status == 304:
         return False
       with open(filename, "wb") as fd:
-        fd.write(response.read())
+        shutil.copyfileobj(response, fd, length=BUFFER_SIZE)
       if "ETag" in response.headers:
         with open(etag_file, "w", encoding='utf-8') as fd:
           fd.write(response.headers["ETag"])
@@ -137,49 +163,58 @@ def download_with_etag(url: str, filename: Path) -> bool:
 
 def retrieve_image(source_path: Path, target_dir: Path) -> None:
   target_name = target_dir.joinpath(source_path.name)
-  if target_name.exists():
-    return
   urllib.request.urlretrieve(NOAA + str(source_path), target_name)
-  add_margin(target_name, 0, 0, 50, 0)
   logger.info('%s saved', target_name)
 
 
-def retrieve_files(enlil_file: Path, target_dir: Path) -> bool:
-  if not download_with_etag(SOURCE_JSON, enlil_file):
-    logging.info('No new version of %s', enlil_file.name)
-    return False
-
-  logging.info('New %s file has been downloaded: processing', enlil_file)
+def load_manifest(enlil_file: Path) -> List[Dict[str, str]]:
   with open(enlil_file, 'r', encoding='utf-8') as fdin:
-    data_source = json.load(fdin)
-    for url in data_source:
-      retrieve_image(Path(url['url']), target_dir)
+    return json.load(fdin)
 
-  return True
+
+def retrieve_files(manifest: List[Dict[str, str]], target_dir: Path) -> None:
+  # The downloads are network bound, urllib releases the GIL while waiting on the socket.
+  existing = frozenset(os.listdir(target_dir))
+  sources = [Path(url['url']) for url in manifest]
+  sources = [src for src in sources if src.name not in existing]
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    list(executor.map(retrieve_image, sources, [target_dir] * len(sources)))
 
 
-def purge(enlil_file: Path, target_dir: Path) -> None:
+def purge(manifest: List[Dict[str, str]], target_dir: Path) -> None:
   """Cleanup old enlil image that are not present in the json manifest"""
   logger.info('Cleaning up non active Enlil images')
-  current_files = set([])
-  with open(enlil_file, 'r', encoding='utf-8') as fdm:
-    data = json.load(fdm)
-    for entry in data:
-      current_files.add(os.path.basename(entry['url']))
+  current_files = frozenset(os.path.basename(entry['url']) for entry in manifest)
 
-  names = (n for n in os.listdir(target_dir) if n.startswith('enlil_com'))
   count = 0
-  for name in names:
-    if name not in current_files:
+  with os.scandir(target_dir) as entries:
+    for entry in entries:
+      if not entry.name.startswith('enlil_com') or entry.name in current_files:
+        continue
       try:
-        os.unlink(os.path.join(target_dir, name))
-        logger.debug('Delete file: %s', name)
+        os.unlink(entry.path)
+        logger.debug('Delete file: %s', entry.name)
         count += 1
       except IOError as exp:
         logger.error(exp)
   logger.info('%d files deleted', count)
 
 
+def remove_padded_frames(target_dir: Path) -> bool:
+  """Frames downloaded before ffmpeg added the margin have it baked in. Delete them once so they
+  are downloaded again, unpadded. Returns True until the frames have been downloaded again."""
+  if target_dir.joinpath(UNPADDED_MARKER).exists():
+    return False
+  count = 0
+  with os.scandir(target_dir) as entries:
+    for entry in entries:
+      if entry.name.startswith('enlil_com'):
+        os.unlink(entry.path)
+        count += 1
+  logger.info('%d padded frames deleted', count)
+  return True
+
+
 def counter(start: int = 1) -> Iterator[str]:
   cnt = start
   while True:
@@ -188,54 +223,113 @@ def counter(start: int = 1) -> Iterator[str]:
 
 
 def select_files(source_dir: Path) -> List[Path]:
-  file_list = []
-  for name in source_dir.glob('*.jpg'):
-    file_list.append(name)
+  file_list = sorted(source_dir.glob('*.jpg'))
   logger.info('%d files selected for animation', len(file_list))
-  return sorted(file_list)
+  return file_list
+
 
+def link_file(target: Path, filename: Path) -> None:
+  target.unlink(missing_ok=True)
+  os.link(filename, target)
+  logger.debug('File "%s" selected', target)
 
-def create_links(workdir: Path, file_list: List[Path]):
-  cnt = counter()
-  for filename in file_list:
-    target = workdir.joinpath(f"enlil-{next(cnt)}.jpg")
-    target.hardlink_to(filename)
-    logger.debug('File "%s" selected', target)
 
+def create_links(workdir: Path, file_list: List[Path]) -> int:
+  """Link the frames into workdir, reusing the links left by the previous run.
+  Returns the number of the first frame."""
+  with os.scandir(workdir) as entries:
+    existing = {e.name: e.inode() for e in entries
+                if e.name.startswith('enlil-') and e.name.endswith('.jpg')}
+  inodes = [filename.stat().st_ino for filename in file_list]
 
-def mk_video(work_dir: Path, video_file: Path):
-  ffmpeg = shutil.which('ffmpeg')
+  # Keep the previous numbering when the first frame is still linked, so only the frames added
+  # or removed since the last run need new links.
+  start = 1
+  for name, inode in existing.items():
+    if inodes and inode == inodes[0]:
+      start = int(name[6:-4])
+      break
+
+  cnt = counter(start)
+  targets, sources = [], []
+  for filename, inode in zip(file_list, inodes):
+    name = f"enlil-{next(cnt)}.jpg"
+    if existing.pop(name, None) != inode:
+      targets.append(workdir.joinpath(name))
+      sources.append(filename)
+
+  for name in existing:
+    workdir.joinpath(name).unlink()
+  logger.info('%d links created, %d removed', len(targets), len(existing))
+
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    list(executor.map(link_file, targets, sources))
+  return start
+
+
+@lru_cache(maxsize=None)
+def ffmpeg_encoders(ffmpeg: str) -> FrozenSet[str]:
+  """Return the names of the encoders compiled in ffmpeg"""
+  proc = run([ffmpeg, '-hide_banner', '-encoders'], capture_output=True, text=True, check=False)
+  return frozenset(cols[1] for cols in (line.split() for line in proc.stdout.splitlines())
+                   if len(cols) > 1)
+
+
+def select_encoders(ffmpeg: str, encoder: str, preset: str) -> List[List[str]]:
+  """List the codec arguments to try, libx264 always comes last.
+  With encoder set to "auto", use the hardware encoders compiled in ffmpeg."""
+  libx264 = ['-c:v', 'libx264', '-preset', preset, '-crf', '23', '-pix_fmt', 'yuv420p']
+  if encoder == 'libx264':
+    return [libx264]
+  if encoder == 'auto':
+    available = ffmpeg_encoders(ffmpeg)
+    names = [name for name in HW_ENCODERS if name in available]
+  else:
+    names = [encoder]
+  return [['-c:v', name, *HW_ENCODERS.get(name, [])] for name in names] + [libx264]
+
+
+def mk_video(work_dir: Path, video_file: Path, encoder: str, preset: str, start: int = 1):
+  ffmpeg = FFMPEG
   if not ffmpeg:
     logging.error('"ffmpeg" not found. Make sure it is correctly installed')
     return
   logfile = Path('/tmp/enlil_animation.log')
   tmp_file = work_dir.joinpath(f"{video_file}-{os.getpid()}.mp4")
   input_files = work_dir.joinpath('enlil-%06d.jpg')
-  in_args = f'-y -framerate 10 -i {input_files}'.split()
-  ou_args = '-an -c:v libx264 -pix_fmt yuv420p -vf scale=800:542'.split()
-  cmd = [ffmpeg, *in_args, *ou_args, str(tmp_file)]
+  in_args = f'-y -framerate 10 -start_number {start} -i {input_files}'.split()
+  # Add a 50 pixels black margin at the bottom of each frame, then scale
+  ou_args = ['-an', '-vf', 'pad=iw:ih+50:0:0:color=black,scale=800:542']
+  ou_args.extend(['-movflags', '+faststart', '-threads', '0'])
 
   logger.info('Writing ffmpeg output in %s', logfile)
-  logger.info("Saving %s video file", tmp_file)
 
   with open(logfile, "a", encoding='ascii') as err:
-    err.write(' '.join(cmd))
-    err.write('\n\n')
-    err.flush()
-    with Popen(cmd, shell=False, stdout=PIPE, stderr=err) as proc:
-      proc.wait()
-    if proc.returncode != 0:
+    # Hardware encoders can be compiled in ffmpeg without the matching device being present.
+    for codec_args in select_encoders(ffmpeg, encoder, preset):
+      cmd = [ffmpeg, *in_args, *codec_args, *ou_args, str(tmp_file)]
+      logger.info("Saving %s video file using %s", tmp_file, codec_args[1])
+      err.write(' '.join(cmd))
+      err.write('\n\n')
+      err.flush()
+      with Popen(cmd, shell=False, stdout=PIPE, stderr=err) as proc:
+        proc.wait()
+      if proc.returncode == 0:
+        break
+      logger.warning('Encoder %s failed', codec_args[1])
+    else:
       logger.error('Error generating the video file')
+      tmp_file.unlink(missing_ok=True)
       return
     logger.info('mv %s %s', tmp_file, video_file)
     tmp_file.rename(video_file)
 
 
-def animate(source_dir: Path, video_file: Path):
+def animate(source_dir: Path, video_file: Path, encoder: str, preset: str):
   with Workdir(source_dir) as work_dir:
     files = select_files(source_dir)
-    create_links(work_dir, files)
-    mk_video(work_dir, video_file)
+    start = create_links(work_dir, files)
+    mk_video(work_dir, video_file, encoder, preset, start)
 
 
 def main():
@@ -252,9 +346,20 @@ def main():
     logging.error('Directory "%s" does not exist', config.target_dir)
     raise SystemExit('Directory not found')
 
-  if retrieve_files(config.enlil_file, config.target_dir) or opts.force:
-    purge(config.enlil_file, config.target_dir)
-    animate(config.target_dir, config.video_file)
+  migrate = remove_padded_frames(config.target_dir)
+  new_data = download_with_etag(SOURCE_JSON, config.enlil_file)
+  if new_data:
+    logging.info('New %s file has been downloaded: processing', config.enlil_file)
+  else:
+    logging.info('No new version of %s', config.enlil_file.name)
+
+  if new_data or migrate or opts.force:
+    manifest = load_manifest(config.enlil_file)
+    if new_data or migrate:
+      retrieve_files(manifest, config.target_dir)
+      config.target_dir.joinpath(UNPADDED_MARKER).touch()
+    purge(manifest, config.target_dir)
+    animate(config.target_dir, config.video_file, config.video_encoder, config.video_preset)
 
 
 if __name__ == "__main__":